@@ -71,14 +71,85 @@ class LVUCache(DynamicCache):
     Inherits from DynamicCache to provide caching functionality.
     """
     
+    QUANT_DTYPES = {"int8": torch.int8, "fp8": torch.float8_e4m3fn}
+
     def __init__(self, _distributed_cache_data: Iterable = None, lvu_config: LVUConfig = None):
         super().__init__(_distributed_cache_data)
         self.lvu_config = lvu_config
         # self.key_cache: List[torch.Tensor] = []
         # self.value_cache: List[torch.Tensor] = []
         self.accum_attn_scores: Dict[int, List[torch.Tensor]] = {}
+        self.snap_attn_scores: Dict[int, torch.Tensor] = {}
         self.prompt_length: int = 0
-        
+        self.kv_cache_dtype: str = getattr(lvu_config, "kv_cache_dtype", None)
+        self._key_scales: Dict[int, torch.Tensor] = {}
+        self._value_scales: Dict[int, torch.Tensor] = {}
+        # small full-precision tail of freshly decoded tokens per layer; the
+        # compressed prefix in key_cache/value_cache is never re-inflated in place
+        self._key_tail: Dict[int, torch.Tensor] = {}
+        self._value_tail: Dict[int, torch.Tensor] = {}
+
+    def _quantize_layer_(self, layer_idx: int):
+        """Compress the given layer's stored K/V so only the compressed copy
+        persists between forwards. Keys get a per-channel absmax scale (channels
+        are the outlier-prone axis), values a per-token scale (per-channel value
+        quantization is the known-weak axis)."""
+        quant_dtype = self.QUANT_DTYPES[self.kv_cache_dtype]
+        for cache, scales, tails, amax_dim in (
+            (self.key_cache, self._key_scales, self._key_tail, 2),
+            (self.value_cache, self._value_scales, self._value_tail, 3),
+        ):
+            states = cache[layer_idx]
+            tail = tails.pop(layer_idx, None)
+            if states.dtype == quant_dtype:
+                # fold the decode tail back into the compressed prefix
+                states = states.to(scales[layer_idx].dtype) * scales[layer_idx]
+                if tail is not None:
+                    states = torch.cat((states, tail), dim=2)
+            # else: a plain stored tensor already holds the whole layer (fresh
+            # prefill output or a pruned write-back), so any leftover tail is stale
+            amax = states.abs().amax(dim=amax_dim, keepdim=True).clamp(min=1e-6)
+            if quant_dtype == torch.int8:
+                scale = amax / 127.0
+                quantized = (states / scale).round().clamp(-127, 127).to(quant_dtype)
+            else:
+                scale = amax / torch.finfo(quant_dtype).max
+                quantized = (states / scale).to(quant_dtype)
+            cache[layer_idx] = quantized
+            scales[layer_idx] = scale
+
+    def _full_layer(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the layer's full-precision K/V as temporaries: the compressed
+        prefix dequantized on the fly plus the decode tail. Nothing is written
+        back, so the resident cache stays compressed."""
+        quant_dtype = self.QUANT_DTYPES[self.kv_cache_dtype]
+        full = []
+        for cache, scales, tails in (
+            (self.key_cache, self._key_scales, self._key_tail),
+            (self.value_cache, self._value_scales, self._value_tail),
+        ):
+            states = cache[layer_idx]
+            if states.dtype == quant_dtype:
+                scale = scales[layer_idx]
+                states = states.to(scale.dtype) * scale
+            tail = tails.get(layer_idx)
+            if tail is not None:
+                states = torch.cat((states, tail), dim=2)
+            full.append(states)
+        return full[0], full[1]
+
+    def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.kv_cache_dtype is not None and layer_idx < len(self.key_cache):
+            return self._full_layer(layer_idx)
+        return super().__getitem__(layer_idx)
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        length = super().get_seq_length(layer_idx)
+        tail = self._key_tail.get(layer_idx)
+        if tail is not None:
+            length += tail.shape[-2]
+        return length
+
     def set_prompt_length(self, prompt_length: int=0):
         """
         Set the prompt length for the cache.
@@ -94,8 +165,46 @@ class LVUCache(DynamicCache):
         layer_idx: int,
         cache_kwargs: Optional[Dict[str, Any]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
+        quantized_prefix = None
+        if self.kv_cache_dtype is not None and layer_idx < len(self.key_cache) \
+                and self.key_cache[layer_idx].dtype == self.QUANT_DTYPES[self.kv_cache_dtype]:
+            # hand super().update a dequantized temporary so the returned K/V
+            # are full precision, but remember the compressed prefix: decode
+            # steps below put it back untouched instead of re-inflating the cache
+            quantized_prefix = (self.key_cache[layer_idx], self.value_cache[layer_idx])
+            self.key_cache[layer_idx], self.value_cache[layer_idx] = self._full_layer(layer_idx)
+            self._key_tail.pop(layer_idx, None)
+            self._value_tail.pop(layer_idx, None)
+        if (
+            cache_kwargs is not None
+            and getattr(self.lvu_config, "top_k_predict_type", None) == "snapkv"
+            and not self.prompt_length
+            and key_states.shape[-2] > 1
+        ):
+            # SnapKV-style scores straight from the query/key states: only the
+            # trailing observation-window queries are scored against this
+            # group's new keys, so no full attention matrix is ever needed
+            query_states = cache_kwargs["query_states"] # (bz, num_heads, Q, head_dim)
+            obs_window = min(32, query_states.shape[2])
+            obs_queries = query_states[:, :, -obs_window:, :]
+            bsz, num_heads, _, head_dim = query_states.shape
+            num_key_value_heads = key_states.shape[1]
+            key_states_repeated = repeat_kv(key_states, num_heads // num_key_value_heads)
+            attn_scores = torch.einsum("bhqd,bhkd->bhqk", obs_queries, key_states_repeated) / (head_dim ** 0.5)
+            # the window queries interleave with the last obs_window keys (unlike
+            # the prompt-based path below, where every query comes after all
+            # scored keys), so mask future keys before normalizing — otherwise
+            # the softmax inflates the scores of each group's tail keys
+            causal_mask = torch.ones(
+                obs_window, obs_window, dtype=torch.bool, device=attn_scores.device
+            ).triu(1)
+            attn_scores[..., -obs_window:].masked_fill_(causal_mask, float("-inf"))
+            attn_scores = torch.softmax(attn_scores, dim=-1, dtype=torch.float32).to(
+                query_states.dtype
+            ).detach() # (bz, num_heads, W, K)
+            self.snap_attn_scores[layer_idx] = attn_scores.sum(-2).mean(1) # (bz, k_len)
         if not self.prompt_length:
-            return super().update(key_states, value_states, layer_idx, cache_kwargs)
+            super_result = super().update(key_states, value_states, layer_idx, cache_kwargs)
         else:
             query_states = cache_kwargs["query_states"] # (bz, num_heads, Q, head_dim)
             query_states = query_states[:, :, -self.prompt_length:, :]
@@ -114,4 +223,16 @@ class LVUCache(DynamicCache):
             attn_scores = attn_scores.sum(-2).mean(1) # average over num_key_value_heads (bz, k_len)
             self.accum_attn_scores[layer_idx] = self.accum_attn_scores.get(layer_idx, [])
             self.accum_attn_scores[layer_idx].append(attn_scores)
-            return super_result
\ No newline at end of file
+        if self.kv_cache_dtype is not None:
+            if key_states.shape[-2] > 1:
+                # re-compress after a (multi-token) group prefill
+                self._quantize_layer_(layer_idx)
+            elif quantized_prefix is not None:
+                # single-token decode: keep the compressed prefix stored as-is
+                # and park the new token in the full-precision tail, so the
+                # resident cache stays quantized throughout generation
+                prefix_len = quantized_prefix[0].shape[-2]
+                self._key_tail[layer_idx] = self.key_cache[layer_idx][:, :, prefix_len:].clone()
+                self._value_tail[layer_idx] = self.value_cache[layer_idx][:, :, prefix_len:].clone()
+                self.key_cache[layer_idx], self.value_cache[layer_idx] = quantized_prefix
+        return super_result
\ No newline at end of file
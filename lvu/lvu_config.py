@@ -22,6 +22,10 @@ class LVUConfig:
     top_k_decay_factor: float = None
     top_k_decay_type: str = None
     query_based: bool = False
+    fuse_post_attention_layernorm: bool = False
+    packed_group_prefill: bool = False
+    stream_group_prefill: bool = False # overlap independent group forwards on CUDA streams (raises peak activation memory)
+    kv_cache_dtype: str = None # "int8" or "fp8" to keep the growing KV cache quantized between video groups
     
     def __post_init__(self):
         # check and auto set default values
@@ -31,6 +35,8 @@ class LVUConfig:
         if "query" in self.top_k_predict_type:
             # this is a query based predict type
             self.query_based = True
+        if self.kv_cache_dtype is not None and self.kv_cache_dtype not in ("int8", "fp8"):
+            raise ValueError(f"Unknown kv_cache_dtype: {self.kv_cache_dtype}")
 @dataclass
 class LVULayerConfig:
     layer_idx: int
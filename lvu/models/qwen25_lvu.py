@@ -1,20 +1,20 @@
 import torch
 import numpy as np
 import dataclasses
+import math
 import time
 import sys
 import hashlib
 from PIL import Image
 from pathlib import Path
-from tqdm import tqdm
 from typing import Optional, Tuple
 from transformers import Qwen2_5_VLForConditionalGeneration, Qwen2_5_VLModel
 from transformers.feature_extraction_utils import BatchFeature
 from transformers.cache_utils import Cache
-from qwen_vl_utils import process_vision_info, extract_vision_info
+from qwen_vl_utils import extract_vision_info
 from ..utils import post_process_kv_cache
 from ..lvu_config import LVUConfig, LVULayerConfig
-from ..lvu_cache import LVUCache, save_ndarray_as_image, load_image_as_ndarray
+from ..lvu_cache import DynamicCache, LVUCache, save_ndarray_as_image, load_image_as_ndarray
 from transformers.models.qwen2_5_vl.modeling_qwen2_5_vl import (
     apply_multimodal_rotary_pos_emb,
     repeat_kv,
@@ -98,17 +98,35 @@ def lvu_qwen25_vl_flash_attention_2_forward(
     else:
         sliding_window = None
 
-    attn_output = _flash_attention_forward(
-        query_states,
-        key_states,
-        value_states,
-        attention_mask,
-        q_len,
-        dropout=dropout_rate,
-        sliding_window=sliding_window,
-        is_causal=self.is_causal,
-        use_top_left_mask=self._flash_attn_uses_top_left_mask,
-    )
+    lvu_config = getattr(getattr(self, "lvu_layer_config", None), "lvu_config", None)
+    packed_cu_seqlens = getattr(lvu_config, "_packed_cu_seqlens", None)
+    if packed_cu_seqlens is not None and bsz == 1 and q_len == lvu_config._packed_total_seqlen:
+        # packed multi-group prefill: one varlen call gives block-diagonal causal
+        # attention, so every group only attends within itself
+        from flash_attn import flash_attn_varlen_func
+        attn_output = flash_attn_varlen_func(
+            query_states.squeeze(0),
+            key_states.squeeze(0),
+            value_states.squeeze(0),
+            cu_seqlens_q=packed_cu_seqlens,
+            cu_seqlens_k=packed_cu_seqlens,
+            max_seqlen_q=lvu_config._packed_max_seqlen,
+            max_seqlen_k=lvu_config._packed_max_seqlen,
+            dropout_p=dropout_rate,
+            causal=True,
+        ).unsqueeze(0)
+    else:
+        attn_output = _flash_attention_forward(
+            query_states,
+            key_states,
+            value_states,
+            attention_mask,
+            q_len,
+            dropout=dropout_rate,
+            sliding_window=sliding_window,
+            is_causal=self.is_causal,
+            use_top_left_mask=self._flash_attn_uses_top_left_mask,
+        )
 
     attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
     attn_output = self.o_proj(attn_output)
@@ -178,7 +196,14 @@ def lvu_qwen25_vl_decoder_layer_forward(
         cache_position=cache_position,
         position_embeddings=position_embeddings,
     )
-    hidden_states = residual.to(hidden_states.device) + hidden_states
+    if residual.device != hidden_states.device:
+        # only pay the copy when the tuple-unpack actually left residual elsewhere
+        residual = residual.to(hidden_states.device, non_blocking=True)
+    if torch.is_grad_enabled():
+        hidden_states = residual + hidden_states
+    else:
+        # inference-mode path from chat_lvu_model: reuse the attn output buffer
+        hidden_states = hidden_states.add_(residual)
     hidden_states, attention_mask, position_ids, cache_position, position_embeddings, present_key_value = post_process_kv_cache(
         hidden_states,
         attention_mask,
@@ -194,7 +219,10 @@ def lvu_qwen25_vl_decoder_layer_forward(
     residual = hidden_states
     hidden_states = self.post_attention_layernorm(hidden_states)
     hidden_states = self.mlp(hidden_states)
-    hidden_states = residual + hidden_states
+    if torch.is_grad_enabled():
+        hidden_states = residual + hidden_states
+    else:
+        hidden_states = hidden_states.add_(residual)
 
     if lvu_config.enable and lvu_layer_config.prune_for_next_layer and not lvu_layer_config.is_last_layer:
         # pass all the pruned information to next layer. If the last layer, we don't need to save other information except hidden_states
@@ -399,6 +427,27 @@ def fetch_video(ele: dict, image_factor: int = IMAGE_FACTOR, return_video_sample
         return images
 
 
+def _floor_by_factor(number, factor: int) -> int:
+    """Largest multiple of factor <= number, in pure integer math (truncating
+    a float input first is exact for the positive values used here)."""
+    return int(number) // factor * factor
+
+def _ceil_by_factor(number, factor: int) -> int:
+    """Smallest multiple of factor >= number; math.ceil first so fractional
+    inputs still round up before the integer alignment."""
+    return -(-math.ceil(number) // factor) * factor
+
+def _round_by_factor(number, factor: int) -> int:
+    """Nearest multiple of factor, half-to-even like round(), without the
+    float division of qwen_vl_utils' round_by_factor for integer inputs."""
+    if not isinstance(number, int):
+        # user-supplied fractional values keep the original float semantics
+        return round(number / factor) * factor
+    quotient, remainder = divmod(number, factor)
+    if 2 * remainder > factor or (2 * remainder == factor and quotient % 2):
+        quotient += 1
+    return quotient * factor
+
 def smart_nframes(
     ele: dict,
     total_frames: int,
@@ -424,18 +473,18 @@ def smart_nframes(
     """
     assert not ("fps" in ele and "nframes" in ele), "Only accept either `fps` or `nframes`"
     if "nframes" in ele:
-        nframes = round_by_factor(ele["nframes"], FRAME_FACTOR)
+        nframes = _round_by_factor(ele["nframes"], FRAME_FACTOR)
         nframes = min(nframes, total_frames)
         nframes -= (nframes % FRAME_FACTOR)
     else:
         fps = ele.get("fps", FPS)
-        min_frames = ceil_by_factor(ele.get("min_frames", FPS_MIN_FRAMES), FRAME_FACTOR)
-        max_frames = floor_by_factor(ele.get("max_frames", min(FPS_MAX_FRAMES, total_frames)), FRAME_FACTOR)
+        min_frames = _ceil_by_factor(ele.get("min_frames", FPS_MIN_FRAMES), FRAME_FACTOR)
+        max_frames = _floor_by_factor(ele.get("max_frames", min(FPS_MAX_FRAMES, total_frames)), FRAME_FACTOR)
         nframes = total_frames / video_fps * fps
         if nframes > total_frames:
             logger.warning(f"smart_nframes: nframes[{nframes}] > total_frames[{total_frames}]")
         nframes = min(min(max(nframes, min_frames), max_frames), total_frames)
-        nframes = floor_by_factor(nframes, FRAME_FACTOR)
+        nframes = _floor_by_factor(nframes, FRAME_FACTOR)
     if not (FRAME_FACTOR <= nframes and nframes <= total_frames):
         raise ValueError(f"nframes should in interval [{FRAME_FACTOR}, {total_frames}], but got {nframes}.")
     return nframes
@@ -469,6 +518,55 @@ def _get_initial_cache_position(self, input_ids, model_kwargs):
     return model_kwargs
 
     
+_lvu_subclass_cache = {}
+
+def _get_lvu_subclass(base_cls, forward_fn):
+    """
+    Build (once per base class) a subclass carrying the LVU forward, so layer
+    instances can be re-classed onto it without mutating the shared transformers
+    class — other Qwen2.5-VL models in the same process keep stock behavior.
+    """
+    if base_cls.__dict__.get("forward") is forward_fn:
+        # already an LVU subclass (e.g. init_lvu_model called twice)
+        return base_cls
+    lvu_cls = _lvu_subclass_cache.get(base_cls)
+    if lvu_cls is None:
+        lvu_cls = type(f"LVU{base_cls.__name__}", (base_cls,), {"forward": forward_fn})
+        _lvu_subclass_cache[base_cls] = lvu_cls
+    return lvu_cls
+
+def _scale_free_rms_norm_forward(self, hidden_states):
+    # RMSNorm forward minus the elementwise weight multiply, for norms whose
+    # scale has been folded into the downstream projections
+    input_dtype = hidden_states.dtype
+    hidden_states = hidden_states.to(torch.float32)
+    variance = hidden_states.pow(2).mean(-1, keepdim=True)
+    hidden_states = hidden_states * torch.rsqrt(variance + self.variance_epsilon)
+    return hidden_states.to(input_dtype)
+
+@torch.no_grad()
+def fuse_post_attention_layernorm_(decoder_layers):
+    """
+    Fold the post_attention_layernorm elementwise scale into the MLP gate/up
+    projection weights, so the norm only has to normalize at runtime.
+    RMSNorm(x) = x / rms(x) * w and the MLP consumes gate_proj/up_proj @ RMSNorm(x),
+    so w can be folded into the input columns of both weight matrices and the
+    norm weight reset to ones. Done in float32 to avoid double rounding in bf16.
+    The norm is then re-classed onto a scale-free forward — leaving the stock
+    forward in place would keep running the weight multiply against the
+    all-ones weight, and the memory-bound elementwise pass would not go away.
+    """
+    scale_free_norm_cls = _get_lvu_subclass(
+        type(decoder_layers[0].post_attention_layernorm), _scale_free_rms_norm_forward
+    )
+    for layer in decoder_layers:
+        norm_weight = layer.post_attention_layernorm.weight
+        for proj in (layer.mlp.gate_proj, layer.mlp.up_proj):
+            fused = proj.weight.to(torch.float32) * norm_weight.to(torch.float32)
+            proj.weight.copy_(fused.to(proj.weight.dtype))
+        norm_weight.fill_(1.0)
+        layer.post_attention_layernorm.__class__ = scale_free_norm_cls
+
 def init_lvu_model(model, config: LVUConfig):
     """
     Initialize the LVU model for Qwen 2.5 VL. 
@@ -485,13 +583,23 @@ def init_lvu_model(model, config: LVUConfig):
         raise ValueError("Model must be either Qwen2_5_VLForConditionalGeneration or Qwen2_5_VLModel")
     
     total_layers= len(decoder_layers)
-    for i, layer in enumerate(decoder_layers):
-        # Set the forward function for each decoder layer and filling the parameters in the config
-        layer.forward = lvu_qwen25_vl_decoder_layer_forward.__get__(layer)
-        layer.self_attn.forward = lvu_qwen25_vl_flash_attention_2_forward.__get__(layer.self_attn)
+    # re-class every layer onto an LVU subclass instead of rebinding a bound
+    # method per instance (which defeats python's method cache) or patching the
+    # shared transformers classes (which would hijack other models in the
+    # process); per-layer state stays in lvu_layer_config
+    lvu_decoder_layer_cls = _get_lvu_subclass(type(decoder_layers[0]), lvu_qwen25_vl_decoder_layer_forward)
+    lvu_attn_cls = _get_lvu_subclass(type(decoder_layers[0].self_attn), lvu_qwen25_vl_flash_attention_2_forward)
+    for layer in decoder_layers:
+        layer.__class__ = lvu_decoder_layer_cls
+        layer.self_attn.__class__ = lvu_attn_cls
+        # filling the parameters in the config
         layer.lvu_layer_config = LVULayerConfig(layer_idx=layer.self_attn.layer_idx, total_layers=total_layers, lvu_config=config)
+        # the attention forward also reads it (packed varlen prefill)
+        layer.self_attn.lvu_layer_config = layer.lvu_layer_config
+    if config.fuse_post_attention_layernorm:
+        fuse_post_attention_layernorm_(decoder_layers)
     model._get_initial_cache_position = _get_initial_cache_position.__get__(model)
-    
+
     return model
 
 def run_lvu_model(self, question, video_path, **generation_kwargs):
@@ -546,43 +654,52 @@ def chat_lvu_model(self, messages, **generation_kwargs):
     vision_info = extract_vision_info(messages)
     assert len(vision_info) == 1, "Only one video is supported for now."
     video_path = Path(vision_info[0]["video"])
-    cache_key = video_path.stem
-    for k, v in vision_info[0].items():
-        if k not in ['type', 'video']:
-            cache_key += f"_{k}={v}"
-    # cache_key = video_path.stem + "_" + hashlib.md5(str(vision_info).encode()).hexdigest()
+    # hash the vision settings (sorted for a stable digest) instead of string-
+    # concatenating every value into the filename, which broke on long or
+    # path-unfriendly option values
+    cache_key = video_path.stem + "_" + hashlib.md5(str(sorted(vision_info[0].items())).encode()).hexdigest()
     cache_dir = Path(cache_dir).expanduser()
     cache_file = cache_dir / f"{cache_key}.pt"
+    cache_frames_file = cache_dir / f"{cache_key}_frames.npy"
     cache_dir.mkdir(parents=True, exist_ok=True)
     if not cache_file.exists():
-        image_inputs, video_inputs, video_kwargs = process_vision_info(messages, return_video_kwargs=True)
+        # reuse the vision_info parsed above for the cache key instead of letting
+        # process_vision_info walk the whole conversation a second time; this path
+        # only ever sees the single video asserted above
+        video_input, video_sample_fps = fetch_video(vision_info[0], return_video_sample_fps=True)
+        image_inputs = None
+        video_inputs = [video_input]
+        video_kwargs = {"fps": [video_sample_fps]}
         # save to cache
         if lvu_config.save_video_cache:
-            cache_images_folder = cache_file.parent / f"{cache_key}_images"
-            cache_images_folder.mkdir(parents=True, exist_ok=True)
-            total_size = 0
-            for i, image in enumerate(video_inputs[0]):
-                # image is a numpy array of (C, H, W)
-                save_ndarray_as_image(image.numpy(), cache_images_folder / f"{i:04d}.jpg")
-                total_size += os.path.getsize(cache_images_folder / f"{i:04d}.jpg")
+            # raw uint8 frames as a single .npy so the cache-hit path can memory-map
+            # instead of decoding per-frame jpgs into RAM
+            np.save(cache_frames_file, video_inputs[0].to(torch.uint8).numpy())
             torch.save({
                 "image_inputs": image_inputs,
                 "video_kwargs": video_kwargs,
             }, cache_file)
-            total_size_gb = total_size / (1024 ** 3)
+            total_size_gb = os.path.getsize(cache_frames_file) / (1024 ** 3)
             print(f"Saved video cache to {cache_file} ({total_size_gb:.2f} GB)")
     else:
         print(f"Cache file {cache_file} found. Loading video frames...")
         results = torch.load(cache_file)
-        image_inputs = results["image_inputs"]
+        # video-only messages cache no images; normalize an empty list to None so
+        # the processor skips its image path entirely
+        image_inputs = results["image_inputs"] or None
         video_kwargs = results["video_kwargs"]
-        video_inputs = []
-        cache_images_folder = cache_file.parent / f"{cache_key}_images"
-        all_images = sorted(cache_images_folder.glob("*.jpg"))
-        for i in range(len(all_images)):
-            image = torch.tensor(load_image_as_ndarray(cache_images_folder / f"{i:04d}.jpg"))
-            video_inputs.append(image)
-        video_inputs = [torch.stack(video_inputs)]
+        if cache_frames_file.exists():
+            # demand-paged load: frames are only read from disk when touched
+            video_inputs = [torch.from_numpy(np.load(cache_frames_file, mmap_mode='r'))]
+        else:
+            # legacy per-frame jpg cache
+            video_inputs = []
+            cache_images_folder = cache_file.parent / f"{cache_key}_images"
+            all_images = sorted(cache_images_folder.glob("*.jpg"))
+            for i in range(len(all_images)):
+                image = torch.tensor(load_image_as_ndarray(cache_images_folder / f"{i:04d}.jpg"))
+                video_inputs.append(image)
+            video_inputs = [torch.stack(video_inputs)]
     end = time.time()
     video_processing_time = end - start
     
@@ -598,11 +715,13 @@ def chat_lvu_model(self, messages, **generation_kwargs):
     processor_end = time.time()
     processor_time = processor_end - processor_start
 
-    whole_inputs = whole_inputs.to(model.device)
-    n_video_tokens = (whole_inputs['input_ids'] == model.config.video_token_id).sum().item()
-    video_token_idxs = (whole_inputs['input_ids'] == model.config.video_token_id).nonzero(as_tuple=True)[1]
+    # scan for video tokens while input_ids are still the processor's CPU tensors,
+    # so neither the compare nor the .item() reads ever sync the CUDA stream
+    video_token_idxs = whole_inputs['input_ids'][0].eq(model.config.video_token_id).nonzero(as_tuple=True)[0]
+    n_video_tokens = video_token_idxs.numel()
     first_video_token_id_idx = video_token_idxs[0].item()
     last_video_token_id_idx = video_token_idxs[-1].item()
+    whole_inputs = whole_inputs.to(model.device)
     position_ids, rope_deltas = model.get_rope_index(
         whole_inputs['input_ids'],
         whole_inputs.get('image_grid_thw', None),
@@ -618,54 +737,136 @@ def chat_lvu_model(self, messages, **generation_kwargs):
     if not video_group_size % temporal_patch_size == 0:
         video_group_size += temporal_patch_size - (video_group_size % temporal_patch_size)
     if video_group_size is not None and video_group_size > 0:
-        video_groups = video_inputs[0].split(video_group_size)
-        assert all(len(group) % 2 == 0 for group in video_groups), "The video group size should be even."
-        video_groups_tokens = [int(n_video_tokens * (len(group) / len(video_inputs[0]))) for group in video_groups]
-        video_grid_thw = whole_inputs['video_grid_thw'][0]
-        video_groups_grid_thw = []
-        for group in video_groups:
-            video_groups_grid_thw.append(
-                torch.tensor(
-                    [(len(group) -1 ) // temporal_patch_size + 1,
-                    video_grid_thw[1],
-                    video_grid_thw[2]]
-                ).unsqueeze(0)
-            )
-        pixel_values_videos_group_size = round((video_group_size / len(video_inputs[0])) * whole_inputs['pixel_values_videos'].shape[0])
+        n_total_frames = len(video_inputs[0])
+        # pure integer group sizing: frame counts, token counts and grid rows are
+        # derived arithmetically instead of splitting the frame tensor and looping
+        # over the resulting views with float ratios
+        video_groups_frames = [video_group_size] * (n_total_frames // video_group_size)
+        if n_total_frames % video_group_size:
+            video_groups_frames.append(n_total_frames % video_group_size)
+        assert all(n_frames % 2 == 0 for n_frames in video_groups_frames), "The video group size should be even."
+        video_groups_tokens = [n_video_tokens * n_frames // n_total_frames for n_frames in video_groups_frames]
+        grid_h, grid_w = whole_inputs['video_grid_thw'][0, 1:].tolist()
+        video_groups_grid_thw = [
+            torch.tensor([[(n_frames - 1) // temporal_patch_size + 1, grid_h, grid_w]])
+            for n_frames in video_groups_frames
+        ]
+        pixel_values_videos_group_size = whole_inputs['pixel_values_videos'].shape[0] * video_group_size // n_total_frames
         pixel_values_videos_groups = whole_inputs['pixel_values_videos'].split(pixel_values_videos_group_size)
     else:
-        video_groups = [video_inputs[0]]
+        video_groups_frames = [len(video_inputs[0])]
         video_groups_tokens = [n_video_tokens]
         video_groups_grid_thw = [whole_inputs['video_grid_thw']]
         pixel_values_videos_groups = [whole_inputs['pixel_values_videos']]
 
     # print("Sampled video frames: ", len(video_inputs[0]))
-    # print("Video groups: ", [len(group) for group in video_groups])
+    # print("Video groups: ", video_groups_frames)
     # print("Video groups tokens: ", video_groups_tokens)
     # print("Video groups grid thw: ", video_groups_grid_thw)
     # print("Pixel values videos groups: ", [group.shape for group in pixel_values_videos_groups])
     
     # preprepare the chunk processing
-    past_key_values = LVUCache()
+    past_key_values = LVUCache(lvu_config=lvu_config)
+    # per-layer ([keys...], [values...]) chunks collected in the non-adaptive path,
+    # concatenated once after the loop instead of re-copying the whole prefix per group
+    group_kv_chunks = None
     past_len = 0
-    video_token_idxs = (whole_inputs['input_ids'] == model.config.video_token_id).nonzero(as_tuple=True)[1]
-    first_video_token_id_idx = video_token_idxs[0].item()
-    last_video_token_id_idx = video_token_idxs[-1].item()
     prompt_input_ids = whole_inputs['input_ids'][:, last_video_token_id_idx + 1:]
     prompt_attention_mask = whole_inputs['attention_mask'][:, last_video_token_id_idx + 1:]
     if lvu_config.query_based:
         past_key_values.set_prompt_length(prompt_input_ids.shape[1])
     video_groups_tokens[0] += first_video_token_id_idx # add the tokens before the first video group as well
-    
+
+    # per-group position_ids views sliced up front; group boundaries are fully
+    # determined by video_groups_tokens so nothing needs slicing inside the loop
+    prompt_length = prompt_input_ids.shape[1] if lvu_config.query_based else 0
+    video_groups_position_ids = []
+    group_start = 0
+    for n_group_tokens in video_groups_tokens:
+        video_groups_position_ids.append(position_ids[:, :, group_start:group_start + n_group_tokens + prompt_length])
+        group_start += n_group_tokens
+
+    # single device-side arange over the whole sequence; every cache_position
+    # below is a view into it instead of a fresh per-group allocation
+    full_cache_position = torch.arange(whole_inputs['input_ids'].shape[1], dtype=torch.int64, device=model.device)
+
     total_prefill = 0
 
+    # all groups can be prefilled in one varlen forward when nothing ties them
+    # together (no shared cache, no per-group prompt); the cu_seqlens handed to
+    # the attention forward keep the attention block-diagonal per group
+    use_packed_prefill = (
+        lvu_config.packed_group_prefill
+        and not lvu_config.adaptive_local_attention
+        and not lvu_config.query_based
+        and len(pixel_values_videos_groups) > 1
+    )
+    if use_packed_prefill and lvu_config.enable and (
+        lvu_config.top_k or (lvu_config.top_p is not None and lvu_config.top_p >= 0)
+    ):
+        raise ValueError(
+            "packed_group_prefill cannot be combined with top-k pruning: once a layer "
+            "prunes the packed span, q_len no longer matches the packed cu_seqlens and "
+            "attention would silently fall back to plain causal over all groups."
+        )
+
+    # groups are independent in the non-adaptive path (no shared cache), so their
+    # forwards can be launched on alternating CUDA streams and only joined before
+    # the final per-layer cat; opt-in because two in-flight forwards roughly
+    # double peak activation memory, and the adaptive path is inherently sequential
+    use_group_streams = (
+        lvu_config.stream_group_prefill
+        and not use_packed_prefill
+        and not lvu_config.adaptive_local_attention
+        and torch.cuda.is_available()
+        and len(pixel_values_videos_groups) > 1
+    )
+    group_streams = [torch.cuda.Stream() for _ in range(2)] if use_group_streams else None
+
     # start processing the video groups
-    print(f"Processing total of {len(video_groups)} video groups, each with {video_group_size} frames.")
-    for i, pixel_values_videos_groups_i in tqdm(enumerate(pixel_values_videos_groups), 
-        desc="Processing video groups", total=len(pixel_values_videos_groups), disable=not lvu_config.use_tqdm):
-        
+    print(f"Processing total of {len(video_groups_tokens)} video groups, each with {video_group_size} frames.")
+    if use_packed_prefill:
         prefill_start = time.time()
-        
+        n_video_span_tokens = sum(video_groups_tokens)
+        group_boundaries = [0]
+        for n_group_tokens in video_groups_tokens:
+            group_boundaries.append(group_boundaries[-1] + n_group_tokens)
+        packed_inputs = {
+            "video_grid_thw": torch.cat(video_groups_grid_thw, dim=0),
+            # only consumed by rope-index computation, which is precomputed above
+            "second_per_grid_ts": whole_inputs['second_per_grid_ts'],
+            "pixel_values_videos": whole_inputs['pixel_values_videos'],
+        }
+        packed_inputs = BatchFeature(data=packed_inputs)
+        packed_inputs['input_ids'] = whole_inputs['input_ids'][:, :n_video_span_tokens]
+        packed_inputs['attention_mask'] = whole_inputs['attention_mask'][:, :n_video_span_tokens]
+        packed_inputs['cache_position'] = full_cache_position[:n_video_span_tokens]
+        packed_inputs['position_ids'] = position_ids[:, :, :n_video_span_tokens]
+        packed_inputs = packed_inputs.to(model.device)
+        packed_inputs['past_key_values'] = past_key_values
+        packed_inputs['use_cache'] = True
+        lvu_config._packed_cu_seqlens = torch.tensor(group_boundaries, dtype=torch.int32, device=model.device)
+        lvu_config._packed_total_seqlen = n_video_span_tokens
+        lvu_config._packed_max_seqlen = max(video_groups_tokens)
+        try:
+            with torch.inference_mode():
+                outputs = model(**packed_inputs)
+        finally:
+            lvu_config._packed_cu_seqlens = None
+        past_key_values = outputs.past_key_values
+        past_len = n_video_span_tokens
+        total_prefill += time.time() - prefill_start
+        pixel_values_videos_groups = []
+    n_groups = len(pixel_values_videos_groups)
+    # throttled manual progress line instead of tqdm, whose per-iteration update
+    # bookkeeping is measurable when the groups themselves are short
+    progress_interval = max(1, n_groups // 10)
+    for i, pixel_values_videos_groups_i in enumerate(pixel_values_videos_groups):
+        if lvu_config.use_tqdm and (i % progress_interval == 0 or i == n_groups - 1):
+            print(f"Processing video groups: {i + 1}/{n_groups}", file=sys.stderr)
+
+        prefill_start = time.time()
+
         group_i_inputs = {
             "video_grid_thw": video_groups_grid_thw[i],
             "second_per_grid_ts": whole_inputs['second_per_grid_ts'],
@@ -677,37 +878,65 @@ def chat_lvu_model(self, messages, **generation_kwargs):
         if lvu_config.query_based:
             group_i_inputs['input_ids'] = torch.cat((group_i_inputs['input_ids'], prompt_input_ids), dim=1)
             group_i_inputs['attention_mask'] = torch.cat((group_i_inputs['attention_mask'], prompt_attention_mask), dim=1)
-        
-        group_i_inputs['cache_position'] = torch.arange(group_i_inputs['input_ids'].shape[1], dtype=torch.int64, device=model.device) + past_len
-        group_i_inputs['position_ids'] = position_ids[:, :, past_len:past_len + group_i_inputs['input_ids'].shape[1]]
+
+        group_i_inputs['cache_position'] = full_cache_position[past_len:past_len + group_i_inputs['input_ids'].shape[1]]
+        group_i_inputs['position_ids'] = video_groups_position_ids[i]
         past_len += video_groups_tokens[i] # only the video group tokens are counted, prompt tokens are not counted
         group_i_inputs = group_i_inputs.to(model.device)
         group_i_inputs['use_cache'] = True
-        
+
         if lvu_config.adaptive_local_attention:
             group_i_inputs['past_key_values'] = past_key_values
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = model(**group_i_inputs)
             # later video groups will use the past key values
             past_key_values = outputs.past_key_values
         else:
-            with torch.no_grad():
-                outputs = model(**group_i_inputs)
-            if not past_key_values:
-                # first time parsing, the video grid information is not correct
-                past_key_values = outputs.past_key_values
+            if group_streams is not None:
+                group_stream = group_streams[i % len(group_streams)]
+                group_stream.wait_stream(torch.cuda.current_stream())
+                # the inputs were allocated on the default stream and their only
+                # reference is dropped when group_i_inputs is rebound next
+                # iteration, so tell the allocator the side stream still reads them
+                for group_input in group_i_inputs.values():
+                    if torch.is_tensor(group_input) and group_input.is_cuda:
+                        group_input.record_stream(group_stream)
+                with torch.cuda.stream(group_stream), torch.inference_mode():
+                    outputs = model(**group_i_inputs)
             else:
-                # update the past key values
-                if isinstance(outputs.past_key_values, Cache):
-                    for i in range(len(outputs.past_key_values)):
-                        past_key_values.update(outputs.past_key_values[i][0], outputs.past_key_values[i][1], i)
-                else:
-                    for i in range(len(outputs.past_key_values)):
-                        for j in range(len(outputs.past_key_values[i])):
-                            past_key_values[i][j] = torch.cat((past_key_values[i][j], outputs.past_key_values[i][j]), dim=2)
+                with torch.inference_mode():
+                    outputs = model(**group_i_inputs)
+            # each group only sees its local attention, so just stash the per-group
+            # K/V chunks here and build the final cache with a single cat per layer
+            group_cache = outputs.past_key_values
+            if not isinstance(group_cache, Cache):
+                # normalize legacy list-of-tuples outputs once instead of
+                # special-casing tuple indexing per layer
+                group_cache = DynamicCache.from_legacy_cache(group_cache)
+            if group_kv_chunks is None:
+                group_kv_chunks = [([], []) for _ in range(len(group_cache))]
+            for layer_idx, (layer_keys, layer_values) in enumerate(zip(group_cache.key_cache, group_cache.value_cache)):
+                if group_streams is not None:
+                    # chunks are allocated on the side stream but consumed and
+                    # freed on the default stream after the join below
+                    layer_keys.record_stream(torch.cuda.current_stream())
+                    layer_values.record_stream(torch.cuda.current_stream())
+                group_kv_chunks[layer_idx][0].append(layer_keys)
+                group_kv_chunks[layer_idx][1].append(layer_values)
         # print(f"past_key_values shape: {past_key_values[0][0].shape}")
         prefill_end = time.time()
         total_prefill += prefill_end-prefill_start
+    if group_kv_chunks is not None:
+        if group_streams is not None:
+            # join the side streams before the chunks are consumed below
+            for group_stream in group_streams:
+                torch.cuda.current_stream().wait_stream(group_stream)
+        for layer_idx, (layer_key_chunks, layer_value_chunks) in enumerate(group_kv_chunks):
+            past_key_values.update(
+                layer_key_chunks[0] if len(layer_key_chunks) == 1 else torch.cat(layer_key_chunks, dim=2),
+                layer_value_chunks[0] if len(layer_value_chunks) == 1 else torch.cat(layer_value_chunks, dim=2),
+                layer_idx,
+            )
     assert past_len < whole_inputs['input_ids'].shape[1], "The past length should be less than the final input length."
     if lvu_config.query_based:
         # reset prompt length as all video groups are processed
@@ -719,7 +948,7 @@ def chat_lvu_model(self, messages, **generation_kwargs):
         "attention_mask": whole_inputs['attention_mask'][:, past_len:],
     }
     final_inputs = BatchFeature(data=final_inputs)
-    final_inputs['cache_position'] = torch.arange(final_inputs.input_ids.shape[1], dtype=torch.int64, device=model.device) + past_len
+    final_inputs['cache_position'] = full_cache_position[past_len:]
     final_inputs['position_ids'] = position_ids[:, :, past_len:]
     assert final_inputs['input_ids'].shape[1] == final_inputs['position_ids'].shape[2], "The input ids and position ids should have the same length, but got {} and {}".format(
         final_inputs['input_ids'].shape[1], final_inputs['position_ids'].shape[2])
@@ -730,7 +959,8 @@ def chat_lvu_model(self, messages, **generation_kwargs):
     cache_enable = lvu_config.enable
     lvu_config.enable = lvu_config.do_top_k_for_query # determine whether to do topk or not
     decoding_start = time.time()
-    generated_ids = model.generate(**final_inputs, **generation_kwargs)
+    with torch.inference_mode():
+        generated_ids = model.generate(**final_inputs, **generation_kwargs)
     decoding_end = time.time()
     lvu_config.enable = cache_enable
     
@@ -41,17 +41,30 @@ def get_top_k_mask_to_predict(attn_weights, keys, values, outputs, top_k=100, pr
         values_i = values[bz_i]
         outputs_i = outputs[bz_i]
         if predict_type == "salient_tokens":
-            slident_value = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:, i]
-                slident_value.append(weights.std().item() + weights.mean().item())
-            top_k_idxs = sorted(range(len(slident_value)), key=lambda x: slident_value[x], reverse=True)[:top_k]
+            # std + mean of weights[i:, i], vectorized over columns via masked sums
+            # (unbiased std to match the old per-column .std() calls); accumulated
+            # in float32 and clamped at zero since the E[x^2] - mean^2 form can
+            # cancel slightly negative for near-constant columns
+            causal_weights = attn_weights_i.to(torch.float32)
+            causal_counts = torch.arange(len(causal_weights), 0, -1, device=causal_weights.device)
+            causal_sums = causal_weights.tril().sum(0)
+            causal_sq_sums = causal_weights.square().tril().sum(0)
+            causal_means = causal_sums / causal_counts
+            causal_vars = ((causal_sq_sums - causal_counts * causal_means.square()) / (causal_counts - 1).clamp(min=1)).clamp(min=0)
+            slident_value = causal_vars.sqrt() + causal_means
+            top_k_idxs = slident_value.argsort(descending=True)[:top_k].tolist()
         elif predict_type == "attention_weights":
-            mean_weights = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:, i]
-                mean_weights.append(weights.mean().item())
-            top_k_idxs = sorted(range(len(mean_weights)), key=lambda x: mean_weights[x], reverse=True)[:top_k]
+            # mean of weights[i:, i] per column == causal column sum / remaining rows
+            causal_counts = torch.arange(len(attn_weights_i), 0, -1, device=attn_weights_i.device)
+            mean_weights = attn_weights_i.tril().sum(0) / causal_counts
+            top_k_idxs = mean_weights.argsort(descending=True)[:top_k].tolist()
+        elif predict_type == "snapkv":
+            # SnapKV-style: keys are ranked by the attention mass the trailing
+            # observation-window queries put on them (precomputed in
+            # LVUCache.update), smoothed with 1D max pooling
+            assert attn_weights_i is not None and attn_weights_i.dim() == 1, f"attn_weights_i should be 1D, but got {None if attn_weights_i is None else attn_weights_i.shape}"
+            snap_scores = F.max_pool1d(attn_weights_i.view(1, 1, -1), kernel_size=7, stride=1, padding=3).view(-1)
+            top_k_idxs = snap_scores.argsort(descending=True)[:top_k].tolist()
         elif predict_type == "query_attention_weights":
             assert attn_weights_i is not None and attn_weights_i.dim() == 1, f"attn_weights_i should be 1D, but got {attn_weights_i.shape}"
             top_k_idxs = attn_weights_i.argsort(descending=True)[:top_k].tolist()
@@ -62,42 +75,27 @@ def get_top_k_mask_to_predict(attn_weights, keys, values, outputs, top_k=100, pr
             weighted_vector_norms = attn_weights_i * vector_norms
             top_k_idxs = weighted_vector_norms.argsort(descending=True)[:top_k].tolist()
         elif predict_type == "attention_weights_sum":
-            sum_weights = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:, i]
-                sum_weights.append(weights.sum().item())
-            top_k_idxs = sorted(range(len(sum_weights)), key=lambda x: sum_weights[x], reverse=True)[:top_k]
+            sum_weights = attn_weights_i.tril().sum(0)
+            top_k_idxs = sum_weights.argsort(descending=True)[:top_k].tolist()
         elif predict_type == "attention_weights_sum_head_tail":
-            sum_weights = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:, i]
-                sum_weights.append(weights.sum().item())
-            top_k_idxs = sorted(range(len(sum_weights)), key=lambda x: sum_weights[x], reverse=True)
+            sum_weights = attn_weights_i.tril().sum(0)
+            top_k_idxs = sum_weights.argsort(descending=True).tolist()
             top_k_idxs = top_k_idxs[:top_k//2] + top_k_idxs[-top_k//2:]
         elif predict_type == "attention_weights_sum_per_image":
-            sum_weights = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:i+258, i] # 258 is the number of tokens in an image
-                sum_weights.append(weights.sum().item())
-            top_k_idxs = sorted(range(len(sum_weights)), key=lambda x: sum_weights[x], reverse=True)[:top_k]
+            # banded sum of weights[i:i+258, i]; 258 is the number of tokens in an image
+            sum_weights = (attn_weights_i.tril() - attn_weights_i.tril(-258)).sum(0)
+            top_k_idxs = sum_weights.argsort(descending=True)[:top_k].tolist()
         elif predict_type == "attention_weights_sum_with_random":
-            sum_weights = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:, i]
-                sum_weights.append(weights.sum().item())
-            top_k_idxs = sorted(range(len(sum_weights)), key=lambda x: sum_weights[x], reverse=True)
-            top_k_idxs = top_k_idxs[:top_k//2]
-            random_top_k_idxs = list(set(list(range(len(sum_weights)))) - set(top_k_idxs))
+            sum_weights = attn_weights_i.tril().sum(0)
+            top_k_idxs = sum_weights.argsort(descending=True)[:top_k//2].tolist()
+            random_top_k_idxs = list(set(range(len(sum_weights))) - set(top_k_idxs))
             random_top_k_idxs = random.sample(random_top_k_idxs, min(top_k//2, len(random_top_k_idxs)))
             top_k_idxs.extend(random_top_k_idxs)
         elif predict_type == "attention_weights_deduplication":
             # pivot:retained tokens = 1:32
             num_pivot_tokens = (top_k - 1) // 2 + 1
-            sum_weights = []
-            for i in range(len(attn_weights_i)):
-                weights = attn_weights_i[i:, i]
-                sum_weights.append(weights.sum().item())
-            top_k_idxs = sorted(range(len(sum_weights)), key=lambda x: sum_weights[x], reverse=True)
+            sum_weights = attn_weights_i.tril().sum(0)
+            top_k_idxs = sum_weights.argsort(descending=True).tolist()
             top_k_idxs, other_top_k_idxs = top_k_idxs[:num_pivot_tokens], top_k_idxs[num_pivot_tokens:]
             # select num_other_tokens from other_top_k_idxs by the lowest cosine similarity
             cur_layer_value_vectors = values_i.transpose(0, 1).flatten(1, 2)
@@ -237,7 +235,12 @@ def post_process_kv_cache(
     if isinstance(present_key_value, LVUCache) and present_key_value.prompt_length > 0:
         q_len -= present_key_value.prompt_length
         attn_weights = present_key_value.accum_attn_scores[layer_idx][-1]
-        
+    elif predict_type == "snapkv" and isinstance(present_key_value, LVUCache):
+        # observation-window scores were computed from the query/key states in
+        # LVUCache.update, so no attention matrix has to be materialized here
+        attn_weights = present_key_value.snap_attn_scores.pop(layer_idx, None)
+
+
     if top_p is not None and top_p >= 0:
         top_k = min((top_k or q_len), int(q_len * top_p))
         
@@ -271,106 +274,66 @@ def post_process_kv_cache(
     old_k_shape = keys.shape
     
     top_k_select_mask = get_top_k_mask_to_predict(attn_weights, keys, values, hidden_states[:, :q_len], top_k=top_k, predict_type=predict_type)
-    
-    top_k_keys_list = []
-    top_k_values_list = []
-    top_k_hidden_states_list = [] if prune_for_next_layer else None
-    top_k_attention_mask_list = [] if prune_for_next_layer else None
-    top_k_position_ids_list = [] if prune_for_next_layer else None
-    top_k_cache_position_list = [] if prune_for_next_layer else None
-    top_k_position_embeddings_list = [] if prune_for_next_layer else None
-    for bz_i in range(bz):
-        top_k_select_mask_i = top_k_select_mask[bz_i]
-        indices = torch.nonzero(top_k_select_mask_i, as_tuple=True)[0].cpu()
-        assert len(indices) == top_k, f"top_k_select_mask_i: {top_k_select_mask_i}, indices: {indices}"
-        
-        bz_top_k_keys = keys[bz_i][:, indices]
-        bz_top_k_values = values[bz_i][:, indices]
-        top_k_keys_list.append(bz_top_k_keys)
-        top_k_values_list.append(bz_top_k_values)
-        
-        if prune_for_next_layer:
-            bz_top_k_hidden_states = hidden_states[bz_i][indices]
-            bz_top_k_cache_position = cache_position[indices]
-            if position_ids.dim() == 3:
-                # (constant, bz, q_len)
-                bz_top_k_position_ids = position_ids[:, bz_i][:, indices]
-            elif position_ids.dim() == 2:
-                # (bz, q_len)
-                bz_top_k_position_ids = position_ids[bz_i][indices]
-            if isinstance(position_embeddings, tuple):
-                bz_top_k_position_embeddings = []
-                for x in position_embeddings:
-                    if x.dim() == 4:
-                        # (constant, bz, q_len, c)
-                        bz_top_k_position_embeddings.append(x[:, bz_i][:, indices])
-                    elif x.dim() == 3:
-                        # (bz, q_len, c)
-                        bz_top_k_position_embeddings.append(x[bz_i][indices])
-                    else:
-                        raise ValueError(f"Unknown position_embeddings shape: {x.shape}")
-                bz_top_k_position_embeddings = tuple(bz_top_k_position_embeddings)
-            elif position_embeddings.dim() == 3:
-                # (bz, q_len, c)
-                bz_top_k_position_embeddings = position_embeddings[bz_i][indices]
-            else:
-                raise ValueError(f"Unknown position_embeddings type: {type(position_embeddings)}")
-            if attention_mask is not None:
-                if attention_mask.dim() == 2:
-                    bz_top_k_attention_mask = attention_mask[bz_i][indices]
-                elif attention_mask.dim() == 4:
-                    bz_top_k_attention_mask = attention_mask[bz_i][:, indices, indices]
-                else:
-                    raise ValueError(f"Unknown attention_mask shape: {attention_mask.shape}")
-            else:
-                bz_top_k_attention_mask = None
-            top_k_hidden_states_list.append(bz_top_k_hidden_states)
-            top_k_attention_mask_list.append(bz_top_k_attention_mask)
-            top_k_position_ids_list.append(bz_top_k_position_ids)
-            top_k_cache_position_list.append(bz_top_k_cache_position)
-            top_k_position_embeddings_list.append(bz_top_k_position_embeddings)
-            
-    top_k_keys = torch.stack(top_k_keys_list, dim=0)
-    top_k_values = torch.stack(top_k_values_list, dim=0)
+
+    # one sorted (temporal-order preserving) index set shared by every gather below;
+    # kept on device so the index_select calls run as a single async gather each
+    # instead of the old per-batch python loop with host-side indices
+    indices = torch.nonzero(top_k_select_mask[0], as_tuple=True)[0]
+    assert indices.numel() == top_k, f"top_k_select_mask: {top_k_select_mask}, indices: {indices}"
+
+    top_k_keys = keys.index_select(2, indices)
+    top_k_values = values.index_select(2, indices)
     keys = torch.cat([past_keys, top_k_keys], dim=2)
     values = torch.cat([past_values, top_k_values], dim=2)
     if isinstance(present_key_value, DynamicCache):
         # present_key_value.update(keys, values, layer_idx)
         present_key_value.key_cache[layer_idx] = keys
         present_key_value.value_cache[layer_idx] = values
+        if getattr(present_key_value, "kv_cache_dtype", None) is not None:
+            # re-compress the pruned write-back, otherwise the cache would stay
+            # full precision between groups whenever pruning is enabled
+            present_key_value._quantize_layer_(layer_idx)
     else:
         present_key_value = (keys, values)
-    
+
     if prune_for_next_layer:
-        hidden_states = torch.stack(top_k_hidden_states_list, dim=0)
-        if not top_k_attention_mask_list or None in top_k_attention_mask_list:
-            attention_mask = None
-        else:
-            attention_mask = torch.stack(top_k_attention_mask_list, dim=0)
+        hidden_states = hidden_states.index_select(1, indices)
+        cache_position = cache_position.index_select(0, indices)
         if position_ids.dim() == 3:
-            position_ids = torch.stack(top_k_position_ids_list, dim=1)
+            # (constant, bz, q_len)
+            position_ids = position_ids.index_select(2, indices)
         elif position_ids.dim() == 2:
-            position_ids = torch.stack(top_k_position_ids_list, dim=0)
-        cache_position = top_k_cache_position_list[0]
-        
+            # (bz, q_len)
+            position_ids = position_ids.index_select(1, indices)
+        else:
+            raise ValueError(f"Unknown position_ids shape: {position_ids.shape}")
+
         if isinstance(position_embeddings, tuple):
             new_position_embeddings = []
-            for i in range(len(position_embeddings)):
-                if position_embeddings[i].dim() == 4:
-                    # (constant, bz, q_len, c), stack in the batch dim
-                    new_position_embeddings.append(torch.stack([x[i] for x in top_k_position_embeddings_list], dim=1))
-                elif position_embeddings[i].dim() == 3:
-                    # (bz, q_len, c), stack in the batch dim
-                    new_position_embeddings.append(torch.stack([x[i] for x in top_k_position_embeddings_list], dim=0))
+            for x in position_embeddings:
+                if x.dim() == 4:
+                    # (constant, bz, q_len, c)
+                    new_position_embeddings.append(x.index_select(2, indices))
+                elif x.dim() == 3:
+                    # (bz, q_len, c)
+                    new_position_embeddings.append(x.index_select(1, indices))
                 else:
-                    raise ValueError(f"Unknown position_embeddings shape: {position_embeddings[i].shape}")
+                    raise ValueError(f"Unknown position_embeddings shape: {x.shape}")
             position_embeddings = tuple(new_position_embeddings)
         elif position_embeddings.dim() == 3:
-            # (bz, q_len, c), stack in the batch dim
-            position_embeddings = torch.stack(top_k_position_embeddings_list, dim=0)
+            # (bz, q_len, c)
+            position_embeddings = position_embeddings.index_select(1, indices)
         else:
             raise ValueError(f"Unknown position_embeddings type: {type(position_embeddings)}")
-        
+
+        if attention_mask is not None:
+            if attention_mask.dim() == 2:
+                attention_mask = attention_mask.index_select(1, indices)
+            elif attention_mask.dim() == 4:
+                attention_mask = attention_mask[:, :, indices, indices]
+            else:
+                raise ValueError(f"Unknown attention_mask shape: {attention_mask.shape}")
+
     # print(f"Reduced keys and values from {old_k_shape} to {top_k_keys.shape} for layer {layer_idx}")
-    
+
     return hidden_states, attention_mask, position_ids, cache_position, position_embeddings, present_key_value
\ No newline at end of file